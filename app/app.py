@@ -3,20 +3,29 @@
 import os
 import sys
 import csv
+import stat
 import time
 import argparse
+import signal
 import yaml
 import json
 import tempfile
+import tarfile
+import mmap
 import shutil
 import re
 import glob
-import pandas as pd
+import fnmatch
 import logging
 from datetime import datetime, timezone
-from pathlib import Path
-from zipfile import ZipFile, ZIP_DEFLATED
+from operator import itemgetter
+from collections import namedtuple, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 import hashlib
+import threading
+import heapq
 
 from waggle.plugin import Plugin, get_timestamp
 
@@ -26,6 +35,37 @@ from waggle.plugin import Plugin, get_timestamp
 UPLOADED_CSV = "uploaded_files.csv"
 SKIPPED_CSV = "skipped_files.csv"
 PROCESSING_LOG = "processing_errors.log"
+HASH_CACHE = "hash_cache.json"
+
+# Hashes are dedupe fingerprints. SHA-256 stays the default so existing upload histories keep
+# matching; hashes from any other algorithm are stored as "<algo>:<hex>" so they never collide
+# with the unprefixed SHA-256 entries already logged.
+DEFAULT_HASH_ALGO = "sha256"
+HASH_ALGOS = ["sha256", "blake2b"]
+HASH_BUFSIZE = 1 << 20
+
+# zstd levels: 1-5 realtime, 10-15 balanced (deflate -9 ratio), 19-22 max ratio
+ZSTD_LEVEL = 10
+
+# Archivers copy file data with one 4 MiB buffer rather than 8-16 KiB read loops
+ARCHIVE_COPY_BUFSIZE = 1 << 22
+# Files at least this big are memory-mapped instead of read when zipping
+MMAP_MIN_SIZE = 1 << 20
+
+# Already-compressed formats gain nothing from deflate, so zip_directory stores them as-is
+PRECOMPRESSED_EXTENSIONS = {
+    ".gz", ".tgz", ".bz2", ".xz", ".zst", ".zip", ".7z",
+    ".jpg", ".jpeg", ".png", ".mp4", ".mkv", ".mp3", ".flac"
+}
+
+# Field order matters: tuples sort by mtime first. file_hash is filled in once during discovery.
+FileInfo = namedtuple("FileInfo", "mtime name path size file_hash", defaults=(None,))
+
+UPLOADED_COLUMNS = ["original_path", "filename", "last_modified_timestamp_source", "file_hash", "size_bytes"]
+SKIPPED_COLUMNS = [
+    "file_path", "reason_skipped", "size_bytes",
+    "last_modified_timestamp_source", "log_timestamp_utc"
+]
 
 
 # ========== Logging Setup ==========
@@ -65,56 +105,176 @@ def validate_metadata(metadata):
     return {str(k): str(v) for k, v in metadata.items()}
 
 
-def read_csv(path):
-    """Reads a CSV into a DataFrame, or creates one with appropriate headers if file doesn't exist."""
-    uploaded_columns = ["original_path", "filename", "last_modified_timestamp_source", "file_hash"]
-
-    skipped_columns = [
-        "file_path", "reason_skipped", "size_bytes",
-        "last_modified_timestamp_source", "log_timestamp_utc"
-    ]
+def read_upload_history(path):
+    """Read the uploaded-files CSV into frozensets of file hashes and (filename, size, mtime) fingerprints."""
+    hashes = set()
+    fingerprints = set()
+    try:
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            if "file_hash" not in header:
+                return frozenset(), frozenset()
+            # Only a few columns are needed, so index them directly rather than building a dict per row
+            hash_col = header.index("file_hash")
+            if {"filename", "size_bytes", "last_modified_timestamp_source"} <= set(header):
+                fp_cols = (header.index("filename"), header.index("size_bytes"),
+                           header.index("last_modified_timestamp_source"))
+            else:
+                fp_cols = None
+
+            for row in reader:
+                if len(row) <= hash_col or not row[hash_col]:
+                    continue
+                hashes.add(row[hash_col])
+                if fp_cols and len(row) > max(fp_cols):
+                    name, size, mtime = (row[i] for i in fp_cols)
+                    try:
+                        fingerprints.add((name, int(size), float(mtime)))
+                    except ValueError:
+                        pass
+    except FileNotFoundError:
+        pass
+    return frozenset(hashes), frozenset(fingerprints)
+
+
+class BatchedCsvWriter:
+    """Thread-safe CSV log kept open for the run, written every `batch_size` rows or `flush_interval` seconds."""
+
+    def __init__(self, path, columns, batch_size=64, flush_interval=5):
+        # None for both leaves a single write at close()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        header = self._add_missing_columns(path, columns)
+        # A 64 KiB buffer lets a whole batch reach the OS in one write rather than one per 8 KiB
+        self._file = open(path, "a", newline="", buffering=1 << 16)
+        # Append mode opens positioned at end of file, so tell() is the size without another stat
+        is_new = self._file.tell() == 0
+        if not is_new and header:
+            columns = header
+        # Keys the log has no column for are dropped, which also skips DictWriter's per-row extra-key check
+        self._writer = csv.DictWriter(self._file, fieldnames=columns, extrasaction="ignore")
+        if is_new:
+            self._writer.writeheader()
+            self._file.flush()
+        self._buf = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _add_missing_columns(path, columns):
+        """Return the existing log's header, first rewriting the log if it lacks any of `columns`."""
+        try:
+            with open(path, newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader, None)
+                missing = [c for c in columns if header and c not in header]
+                if not missing:
+                    return header
+                logging.info(f"Adding columns {missing} to {path}")
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w", newline="") as out:
+                    writer = csv.writer(out)
+                    writer.writerow(header + missing)
+                    writer.writerows(row + [""] * (len(header) + len(missing) - len(row)) for row in reader)
+        except FileNotFoundError:
+            return None
+        os.replace(tmp_path, path)
+        return header + missing
+
+    def append(self, row_dict):
+        with self._lock:
+            self._buf.append(row_dict)
+            if (self.batch_size and len(self._buf) >= self.batch_size) or \
+                    (self.flush_interval and time.monotonic() - self._last_flush > self.flush_interval):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buf:
+            self._writer.writerows(self._buf)
+            self._buf.clear()
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+@lru_cache(maxsize=1024)
+def iso_utc(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
 
-    if not os.path.exists(path):
-        if "uploaded" in str(path):
-            df = pd.DataFrame(columns=uploaded_columns)
-        elif "skipped" in str(path):
-            df = pd.DataFrame(columns=skipped_columns)
-        else:
-            df = pd.DataFrame()
-        df.to_csv(path, index=False)
-        return df
 
-    return pd.read_csv(path)
+def utc_now():
+    """Current time for log rows; second resolution, no datetime object and no cache entry."""
+    return time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime())
 
 
-def append_to_csv(path, row_dict):
-    df = pd.DataFrame([row_dict])
-    if not os.path.exists(path):
-        df.to_csv(path, index=False)
-    else:
-        df.to_csv(path, mode='a', header=False, index=False)
+def compute_file_hash(file_path, hash_algo=DEFAULT_HASH_ALGO):
+    """Compute hash of a file, prefixed with the algorithm name unless it is the default."""
+    # One reused 1 MiB buffer and unbuffered readinto: a Python iteration per MiB and no per-read
+    # allocation. (hashlib.file_digest runs the same loop in Python, over a 256 KiB buffer.)
+    hash_func = hashlib.new(hash_algo)
+    buf = bytearray(HASH_BUFSIZE)
+    view = memoryview(buf)
+    with open(file_path, 'rb', buffering=0) as f:
+        while size := f.readinto(buf):
+            hash_func.update(view[:size])
+    digest = hash_func.hexdigest()
+    return digest if hash_algo == DEFAULT_HASH_ALGO else f"{hash_algo}:{digest}"
 
 
-def iso_utc(ts):
-    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+class HashCache:
+    """
+    File hashes persisted across runs, keyed by path and invalidated when size, mtime or hash
+    algorithm change, so unchanged files aren't re-read on every scan. Only entries used during the run are saved,
+    which drops files that no longer exist.
+    """
 
+    def __init__(self, path=None, hash_algo=DEFAULT_HASH_ALGO):
+        self.path = path
+        self.hash_algo = hash_algo
+        self._cached = self._load() if path else {}
+        self._used = {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable hash cache {self.path}: {e}")
+            return {}
+
+    def file_hash(self, file_path, size, mtime):
+        key = [size, mtime, self.hash_algo]
+        # Entries hashed earlier in this run count too, so scanning again doesn't re-read files
+        entry = self._used.get(file_path) or self._cached.get(file_path)
+        if entry and entry[:3] == key:
+            file_hash = entry[3]
+        else:
+            file_hash = compute_file_hash(file_path, self.hash_algo)
+        self._used[file_path] = key + [file_hash]
+        return file_hash
 
-def compute_file_hash(file_path, hash_algo='sha256'):
-    """Compute hash of a file."""
-    hash_func = hashlib.new(hash_algo)
-    with open(file_path, 'rb') as f:
-        while chunk := f.read(8192):
-            hash_func.update(chunk)
-    return hash_func.hexdigest()
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._used, f)
+        os.replace(tmp_path, self.path)
 
 
-def file_already_uploaded(file_path, uploaded_df, hash_algo='sha256'):
+def file_already_uploaded(file_path, uploaded_hashes, hash_algo=DEFAULT_HASH_ALGO):
     """Check if a file with the same hash has already been uploaded (regardless of name)."""
-    file_hash = compute_file_hash(file_path, hash_algo)
-
-    matches = uploaded_df[uploaded_df['file_hash'] == file_hash]
-
-    return not matches.empty
+    return is_already_uploaded(compute_file_hash(file_path, hash_algo), uploaded_hashes)
 
 
 
@@ -125,154 +285,297 @@ def zip_directory(source_path, level):
             for file in files:
                 full_path = os.path.join(root, file)
                 arcname = os.path.relpath(full_path, start=source_path)
-                zipf.write(full_path, arcname)
+                zinfo = ZipInfo.from_file(full_path, arcname)
+                if os.path.splitext(file)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+                    zinfo.compress_type = ZIP_STORED
+                else:
+                    zinfo.compress_type = ZIP_DEFLATED
+                    zinfo._compresslevel = level  # set by ZipFile.write, but not by ZipFile.open
+                with open(full_path, 'rb') as src, zipf.open(zinfo, 'w') as dst:
+                    copy_file_into(src, dst, zinfo.file_size)
     return temp_file.name
 
 
-# ========== File Discovery ==========
-def discover_files(folder_path, glob_pattern, recursive, uploaded_df, skip_last_n, sort_key, transfer_symlinks):
-    """Scan folder_path for eligible files to upload, applying filters and exclusions."""
-    logging.info("Scanning for files...")
-    all_files = []
+def copy_file_into(src, dst, size):
+    """
+    Copy an open binary file into dst. Files over MMAP_MIN_SIZE are mapped and handed to dst in
+    ARCHIVE_COPY_BUFSIZE slices straight from the page cache, skipping the read() copy into a
+    Python buffer; output memory stays bounded by the slice size.
+    """
+    if size < MMAP_MIN_SIZE:
+        shutil.copyfileobj(src, dst, ARCHIVE_COPY_BUFSIZE)
+        return
 
-    if glob_pattern:
-        #when --recursive is enabled
-        pattern = f"**/{glob_pattern}" if recursive else glob_pattern
-    else:
-        pattern = "**/*" if recursive else "*"
+    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+        for offset in range(0, len(view), ARCHIVE_COPY_BUFSIZE):
+            dst.write(view[offset:offset + ARCHIVE_COPY_BUFSIZE])
 
-    base_path = Path(folder_path)
-    
-    base_path = Path(folder_path)
+
+def tar_zst_directory(source_path, level=ZSTD_LEVEL, workers=None):
+    """
+    Stream source_path into a temporary .tar.zst archive without buffering it in memory.
+    Compression runs on `workers` threads inside libzstd (default: all CPU cores).
+    """
+    # Optional dependency (not in requirements.txt): only needed once the tar.zst archiver is used
+    import zstandard
+
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tar.zst")
+    compressor = zstandard.ZstdCompressor(level=level, threads=workers or -1)
+    # The tar stream would otherwise hand zstd 10 KiB records, and zstd write back ~128 KiB blocks;
+    # matching both to the copy buffer keeps the Python <-> libzstd calls few and large.
+    with temp_file, compressor.stream_writer(temp_file, closefd=False, write_size=ARCHIVE_COPY_BUFSIZE) as zst_stream:
+        with tarfile.open(mode="w|", fileobj=zst_stream, bufsize=ARCHIVE_COPY_BUFSIZE,
+                          copybufsize=ARCHIVE_COPY_BUFSIZE) as tar:
+            for root, dirs, files in os.walk(source_path):
+                for file in files:
+                    full_path = os.path.join(root, file)
+                    arcname = os.path.relpath(full_path, start=source_path)
+                    tar.add(full_path, arcname)
+    return temp_file.name
+
+
+# ========== File Discovery ==========
+def discover_files(folder_path, glob_pattern, recursive, uploaded_hashes, skip_last_n, sort_key, transfer_symlinks,
+                   limit=None, hash_cache=None, hash_workers=1, uploaded_fingerprints=frozenset(),
+                   max_file_size=None, on_oversized=None, exclude=frozenset()):
+    """
+    Scan folder_path for eligible files to upload, applying filters and exclusions.
+    Returns up to `limit` files in sort order and the number eligible after skip_last_n.
+    """
+    logging.info("Scanning for files...")
+    if hash_cache is None:
+        hash_cache = HashCache()
 
     if glob_pattern and "{" in glob_pattern and "}" in glob_pattern:
         ext_match = re.search(r"\*\.\{(.+?)\}", glob_pattern)
-        if ext_match:
-            extensions = [f".{ext.strip().lower()}" for ext in ext_match.group(1).split(",")]
-            paths = sorted([
-                p for p in base_path.rglob("*")
-                if p.is_file() and p.suffix.lower() in extensions
-            ])
-        else:
+        if not ext_match:
             logging.warning(f"Invalid multi-extension glob pattern: {glob_pattern}")
-            paths = []
+            return [], 0
+        # One case-insensitive alternation instead of a splitext + set lookup per entry
+        extensions = "|".join(re.escape(ext.strip()) for ext in ext_match.group(1).split(","))
+        name_matches = re.compile(rf"(?s:.*)\.(?:{extensions})\Z", re.IGNORECASE).match
+    elif glob_pattern:
+        # Translate the glob once instead of going through fnmatch for every entry
+        name_matches = re.compile(fnmatch.translate(glob_pattern)).match
     else:
-        pattern = f"**/{glob_pattern}" if recursive and glob_pattern else glob_pattern or ("**/*" if recursive else "*")
-        paths = sorted(base_path.rglob(pattern) if recursive else base_path.glob(pattern))
+        name_matches = None
+
+    sort_field = itemgetter(0) if sort_key == "mtime" else itemgetter(1)
+
+    found = 0
 
+    def candidates():
+        for entry in scan_directory(folder_path, recursive):
+            if name_matches and not name_matches(entry.name):
+                continue
 
+            # Files the caller already tried this run, when it scans again for more
+            if entry.path in exclude:
+                continue
 
-    for path in paths:
-        if should_skip_file(path, transfer_symlinks):
-            continue
+            if should_skip_file(entry, transfer_symlinks):
+                continue
 
-        file_info = get_file_stat_info(path)
-        if not file_info:
-            continue
+            file_info = get_file_stat_info(entry)
+            if not file_info:
+                continue
 
-        if is_already_uploaded(file_info["path"], uploaded_df):
-            logging.info(f"Skipping already uploaded: {file_info['path']}")
-            continue
+            if (file_info.name, file_info.size, file_info.mtime) in uploaded_fingerprints:
+                logging.info(f"Skipping already uploaded: {file_info.path}")
+                continue
 
-        all_files.append(file_info)
+            # Dropped before hashing and selection, so oversized files can't take any of the `limit` places
+            if max_file_size and file_info.size > max_file_size:
+                logging.warning(f"Skipping {file_info.path}: max_size_exceeded")
+                if on_oversized:
+                    on_oversized(file_info)
+                continue
 
-    # Sort files
-    if sort_key == "mtime":
-        all_files.sort(key=lambda x: x["mtime"])
+            yield file_info
+
+    def with_hash(file_info):
+        # Hash once here; the result travels with the FileInfo so the upload step doesn't re-read the file
+        try:
+            return file_info._replace(file_hash=hash_cache.file_hash(file_info.path, file_info.size, file_info.mtime))
+        except OSError as e:
+            logging.warning(f"Failed to hash file {file_info.path}: {e}")
+            return None
+
+    def eligible_files():
+        nonlocal found
+        # hashlib releases the GIL while hashing, so hash_workers threads scale up to disk bandwidth
+        for file_info in map_in_threads(with_hash, candidates(), hash_workers):
+            if file_info is None:
+                continue
+
+            if is_already_uploaded(file_info.file_hash, uploaded_hashes):
+                logging.info(f"Skipping already uploaded: {file_info.path}")
+                continue
+
+            found += 1
+            yield file_info
+
+    if limit is None:
+        all_files = sorted(eligible_files(), key=sort_field)
     else:
-        all_files.sort(key=lambda x: x["name"])
+        # Only the first limit + skip_last_n files in sort order can be selected, so stream the scan
+        # through a bounded heap; memory stays at that size however large the tree is.
+        all_files = heapq.nsmallest(limit + skip_last_n, eligible_files(), key=sort_field)
 
-    # Skip most recent N files
+    # Skip most recent N files (the last N of everything found, in sort order)
+    pending = max(0, found - skip_last_n)
     if skip_last_n > 0:
-        deferred = all_files[-skip_last_n:]
-        all_files = all_files[:-skip_last_n]
-        logging.info(f"Skipping {len(deferred)} recently modified files")
+        logging.info(f"Skipping {found - pending} recently modified files")
+    keep = pending if limit is None else min(pending, limit)
 
-    return all_files
+    return all_files[:keep], pending
 
-def is_hidden_path(path: Path) -> bool:
-    """Check if any part of the path is hidden (starts with a dot)."""
-    return any(part.startswith('.') for part in path.parts)
 
+def map_in_threads(fn, iterable, workers, ordered=True):
+    """Like map(), but on `workers` threads with at most 2 * workers items in flight."""
+    if workers <= 1:
+        yield from map(fn, iterable)
+        return
 
-def should_skip_file(path: Path, transfer_symlinks: bool) -> bool:
-    """Determine if the file should be skipped based on type, symlink, or hidden folder."""
-    if path.is_dir():
-        return True
-    if path.is_symlink() and not transfer_symlinks:
-        logging.debug(f"Skipping symlink: {path}")
-        return True
-    if is_hidden_path(path):
-        logging.debug(f"Skipping hidden path: {path}")
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        if ordered:
+            pending = deque()
+            for item in iterable:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+            return
+
+        # Yield results as they finish, so one slow item doesn't stop new ones being queued
+        pending = set()
+        for item in iterable:
+            pending.add(executor.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+    finally:
+        # If the caller stops early (an error, or SystemExit from SIGTERM) only the items already
+        # running finish; queued ones are dropped rather than started.
+        executor.shutdown(cancel_futures=True)
+
+
+def scan_directory(path, recursive):
+    """
+    Yield os.DirEntry objects for non-directory entries under path, pruning hidden files and folders.
+    Walks with an explicit stack rather than recursive generators, so entries deep in the tree
+    aren't passed up through one generator frame per level and depth isn't bound by the recursion limit.
+    """
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        subdirs = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        logging.debug(f"Skipping hidden path: {entry.path}")
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirs.append(entry.path)
+                        continue
+                    yield entry
+        except OSError as e:
+            logging.warning(f"Failed to scan directory {current}: {e}")
+        # Reversed so subdirectories are visited in scandir order
+        pending.extend(reversed(subdirs))
+
+
+def should_skip_file(entry: os.DirEntry, transfer_symlinks: bool) -> bool:
+    """Determine if the entry should be skipped for being a symlink (uses scandir's cached type, no syscall)."""
+    if entry.is_symlink() and not transfer_symlinks:
+        logging.debug(f"Skipping symlink: {entry.path}")
         return True
     return False
 
 
-def get_file_stat_info(path: Path):
-    """Get file size, mtime, and name with safe error handling."""
+def get_file_stat_info(entry: os.DirEntry):
+    """
+    Get file size, mtime, and name with safe error handling. This is the only stat call per entry;
+    anything that isn't a regular file (symlinked directories, FIFOs, sockets, devices) is dropped here.
+    """
     try:
-        stat = path.stat()
-        return {
-            "path": str(path),
-            "size": stat.st_size,
-            "mtime": stat.st_mtime,
-            "name": path.name
-        }
+        st = entry.stat()
     except Exception as e:
-        logging.warning(f"Failed to stat file {path}: {e}")
+        logging.warning(f"Failed to stat file {entry.path}: {e}")
         return None
 
+    if not stat.S_ISREG(st.st_mode):
+        logging.debug(f"Skipping non-regular file: {entry.path}")
+        return None
+    return FileInfo(st.st_mtime, entry.name, entry.path, st.st_size)
 
-def is_already_uploaded(path: str, uploaded_df) -> bool:
-    """Return True if the file is already uploaded (based on hash)."""
-    return file_already_uploaded(path, uploaded_df)
 
+def is_already_uploaded(file_hash: str, uploaded_hashes) -> bool:
+    """Return True if a file with this hash is already uploaded."""
+    return file_hash in uploaded_hashes
 
 
-# ========== Upload Logic ==========
-def prepare_and_upload_file(file_info, plugin, base_metadata, args, uploaded_df, skipped_df):
-    path = file_info["path"]
-    size = file_info["size"]
-    mtime = file_info["mtime"]
-    filename = os.path.basename(path)
-
-    if args.max_file_size and size > args.max_file_size:
-        reason = "max_size_exceeded"
-        logging.warning(f"Skipping {path}: {reason}")
-        append_to_csv(args.skipped_csv, {
-            "file_path": path,
-            "reason_skipped": reason,
-            "size_bytes": size,
-            "last_modified_timestamp_source": mtime,
-            "log_timestamp_utc": iso_utc(time.time())
-        })
-        plugin.publish("error", f'''Skipped {path} reason: {reason} 
-                       upload_name: {base_metadata.get("upload_name", "unknown")}''')
-        return False, 0
 
-    metadata = base_metadata.copy()
-    metadata.update({
-        "original_path": str(path),
-        "filename": str(filename),
-        "size_bytes": str(size),
-        "last_modified_timestamp_source": iso_utc(mtime)
+# ========== Upload Logic ==========
+def prepare_metadata(file_info, base_metadata):
+    """
+    Build a file's upload metadata. file_info.file_hash must already be set by discovery, which
+    hashes with the configured --hash-algo.
+    """
+    # Only the per-file fields change; merge them over the validated base metadata in one step.
+    # (A ChainMap would avoid the copy, but pywaggle copies and json-dumps meta, which needs a real dict.)
+    return {
+        **base_metadata,
+        "original_path": file_info.path,
+        "filename": file_info.name,
+        "size_bytes": str(file_info.size),
+        "last_modified_timestamp_source": iso_utc(file_info.mtime),
+        "file_hash": file_info.file_hash
+    }
+
+
+def log_skipped(file_info, reason, args):
+    args.skipped_log.append({
+        "file_path": file_info.path,
+        "reason_skipped": reason,
+        "size_bytes": file_info.size,
+        "last_modified_timestamp_source": file_info.mtime,
+        "log_timestamp_utc": utc_now()
     })
 
-    file_to_upload = path
 
-    # Calculate file hash
-    file_hash = compute_file_hash(file_to_upload)
+def skip_oversized(file_info, plugin, args):
+    """Record a file dropped at discovery for exceeding --max-file-size."""
+    reason = "max_size_exceeded"
+    log_skipped(file_info, reason, args)
+    plugin.publish("error", f"Skipped {file_info.path} reason: {reason} {args.upload_tag}")
 
-    metadata["file_hash"] = file_hash
+
+def prepare_and_upload_file(file_info, plugin, base_metadata, args):
+    """Upload one file and log the outcome. Safe to call from several upload threads at once."""
+    path = file_info.path
+    size = file_info.size
+    mtime = file_info.mtime
+    filename = file_info.name
+    file_to_upload = path
 
     try:
+        metadata = prepare_metadata(file_info, base_metadata)
+        file_hash = metadata["file_hash"]
+
         if args.dry_run:
             logging.info(f"[Dry Run] Would not upload: {file_to_upload}")
             plugin.publish("status", f"[Dry Run] Would not upload: {file_to_upload}")
             return True, size
 
-        #plugin.publish("status", f'''Uploading {filename} 
-        #               upload_name: {metadata.get("upload_name", "unknown")}''')
+        #plugin.publish("status", f"Uploading {filename} {args.upload_tag}")
 
         if args.timestamp == 'mtime':
             timestamp = int(mtime * 1e9)
@@ -281,12 +584,15 @@ def prepare_and_upload_file(file_info, plugin, base_metadata, args, uploaded_df,
 
         plugin.upload_file(file_to_upload, metadata, timestamp=timestamp, keep=True)
 
-        append_to_csv(args.uploaded_csv, {
+        args.uploaded_log.append({
             "original_path": path,
             "filename": filename,
             "last_modified_timestamp_source": mtime,
-            "file_hash": file_hash
+            "file_hash": file_hash,
+            "size_bytes": size
         })
+        # Write through right away so a crash can't cause a re-upload
+        args.uploaded_log.flush()
 
 
         if args.delete_files:
@@ -296,26 +602,42 @@ def prepare_and_upload_file(file_info, plugin, base_metadata, args, uploaded_df,
 
         # Format to ISO string or custom format
         timestamp_str = dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
-        plugin.publish("status", f'''Uploaded {filename}
-                       upload_name: {metadata.get("upload_name", "unknown")} at {timestamp_str}''')
+        plugin.publish("status", f"Uploaded {filename} {args.upload_tag} at {timestamp_str}")
 
         return True, size
 
     except Exception as e:
         logging.error(f"Failed to upload {path}: {e}")
-        append_to_csv(args.skipped_csv, {
-            "file_path": path,
-            "reason_skipped": str(e),
-            "size_bytes": size,
-            "last_modified_timestamp_source": mtime,
-            "log_timestamp_utc": iso_utc(time.time())
-        })
-        plugin.publish("error", f'''Failed to upload {filename} error_details: {str(e)},
-                       upload_name: {metadata.get("upload_name", "unknown")}''')
+        log_skipped(file_info, str(e), args)
+        plugin.publish("error", f"Failed to upload {filename} error_details: {str(e)}, {args.upload_tag}")
         return False, 0
 
 
+class Pacer:
+    """
+    Spaces out calls to wait(), from any number of threads, at least `interval` seconds apart.
+    Time spent between calls counts toward the gap, and nothing waits after the last call.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
 # ========== Main ==========
+def handle_sigterm(signum, frame):
+    raise SystemExit(128 + signum)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="FileForager - Sync files from local folders to Beehive via Waggle plugin.upload_file."
@@ -330,14 +652,23 @@ def main():
     parser.add_argument("--sort-key", choices=["mtime", "name"], default="mtime", help="Sort files by 'mtime' or 'name'.")
     parser.add_argument("--max-file-size", type=int, default=1 * 1024 * 1024 * 1024, help="Maximum file size to upload (in bytes).")
     parser.add_argument("--num-files", type=int, default=10, help="Number of files to upload per run.")
-    parser.add_argument("--sleep", type=float, default=3, help="Sleep time (in seconds) between file uploads.")
+    parser.add_argument("--sleep", type=float, default=3,
+                        help="Pacing interval (in seconds): at most --concurrency uploads start per interval.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of files uploaded at the same time.")
     parser.add_argument("--dry-run", action="store_true", help="Preview actions without uploading files.")
     parser.add_argument("--delete-files", action="store_true", help="Delete source files after successful upload.")
     parser.add_argument("--transfer-symlinks", action="store_true", help="Follow and upload symlinks (default: skip).")
+    parser.add_argument("--hash-algo", choices=HASH_ALGOS, default=DEFAULT_HASH_ALGO,
+                        help="Hash used to detect already uploaded files. blake2b is faster than sha256 without "
+                             "SHA CPU extensions, but files logged under another algorithm will be uploaded again.")
+    parser.add_argument("--hash-workers", type=int, default=min(8, os.cpu_count() or 1),
+                        help="Number of threads hashing files during the scan.")
     parser.add_argument("--DEBUG", action="store_true", help="Enable detailed debug logging.")
 
 
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
     setup_logging(args)
 
     config_dir = f'{args.source}/.forager/'
@@ -350,6 +681,7 @@ def main():
 
     args.uploaded_csv = os.path.join(config_dir, UPLOADED_CSV)
     args.skipped_csv = os.path.join(config_dir, SKIPPED_CSV)
+    args.hash_cache = os.path.join(config_dir, HASH_CACHE)
 
     metadata_path = os.path.join(config_dir, "metadata.yaml")
     metadata = load_yaml_file(metadata_path)
@@ -359,32 +691,82 @@ def main():
 
     metadata = validate_metadata(metadata)
 
-    # If no CSV file found then create an empty dataframe with correct columns.
-    uploaded_df = read_csv(args.uploaded_csv)
-    skipped_df = read_csv(args.skipped_csv)
-
-    with Plugin() as plugin:
-        files = discover_files(args.source, args.glob,
-                               args.recursive, uploaded_df, args.skip_last_file,
-                               args.sort_key, args.transfer_symlinks)
-        logging.info(f"Found {len(files)} files to process.")
-        plugin.publish("status", f'''Found {len(files)} recent files. upload_name: {metadata.get("upload_name", "unknown")}''')
-
-        count = 0
-        total_bytes = 0
-        for file_info in files:
-            if count >= args.num_files:
-                break
-            success, size = prepare_and_upload_file(file_info, plugin, metadata, args, uploaded_df, skipped_df)
-            if success:
-                count += 1
-                total_bytes += size
-            time.sleep(args.sleep)
-
-        plugin.publish("upload.stats", f'''transferred_count: {count} , 
-                       total_bytes: {total_bytes},
-                       upload_name: {metadata.get("upload_name", "unknown")}''')
-        logging.info("Run complete.")
+    # Same tag on every published message; format it once per run
+    args.upload_tag = f'upload_name: {metadata.get("upload_name", "unknown")}'
+
+    # Hashes of files already uploaded; read-only for the rest of the run
+    uploaded_hashes, uploaded_fingerprints = read_upload_history(args.uploaded_csv)
+    hash_cache = HashCache(args.hash_cache, args.hash_algo)
+
+    # Logs are created with their header row if they don't exist yet
+    # The uploaded log is flushed after every upload; skipped rows are only diagnostics,
+    # so they are written once at the end of the run.
+    args.uploaded_log = BatchedCsvWriter(args.uploaded_csv, UPLOADED_COLUMNS)
+    args.skipped_log = BatchedCsvWriter(args.skipped_csv, SKIPPED_COLUMNS, batch_size=None, flush_interval=None)
+
+    # Container stops send SIGTERM; turn it into SystemExit so the finally below still flushes the logs
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    try:
+        with Plugin() as plugin:
+            count = 0
+            total_bytes = 0
+            # Paths uploaded, failed or skipped for size this run. Failures don't count toward
+            # --num-files, so after any the tree is scanned again for the next files not tried yet.
+            attempted = set()
+
+            def skip(file_info):
+                attempted.add(file_info.path)
+                skip_oversized(file_info, plugin, args)
+
+            def scan():
+                files, pending = discover_files(args.source, args.glob,
+                                                args.recursive, uploaded_hashes, args.skip_last_file,
+                                                args.sort_key, args.transfer_symlinks, limit=args.num_files - count,
+                                                hash_cache=hash_cache, hash_workers=args.hash_workers,
+                                                max_file_size=args.max_file_size, on_oversized=skip,
+                                                exclude=attempted, uploaded_fingerprints=uploaded_fingerprints)
+                attempted.update(file_info.path for file_info in files)
+                # Save after every complete scan, so an interrupted upload phase keeps this run's hashes
+                hash_cache.save()
+                return files, pending
+
+            files, pending = scan()
+            logging.info(f"Found {pending} files to process.")
+            plugin.publish("status", f"Found {pending} recent files. {args.upload_tag}")
+
+            # Keep --concurrency uploads going: a worker takes the next file as soon as its upload
+            # finishes, while the pacer spreads the starts evenly over each --sleep interval.
+            pacer = Pacer(0 if args.dry_run else args.sleep / args.concurrency)
+
+            def upload(file_info):
+                pacer.wait()
+                return prepare_and_upload_file(file_info, plugin, metadata, args)
+
+            while files:
+                failed = 0
+                for success, size in map_in_threads(upload, files, args.concurrency, ordered=False):
+                    if success:
+                        count += 1
+                        total_bytes += size
+                    else:
+                        failed += 1
+
+                if not failed:
+                    break
+                # Every rescan has to follow at least one success, so there are at most --num-files of
+                # them; when a whole round fails the problem is likely not the files, so stop.
+                if failed == len(files):
+                    logging.warning(f"All {failed} uploads in the last round failed; not scanning for more files.")
+                    break
+                files, _ = scan()
+
+            plugin.publish("upload.stats",
+                           f"transferred_count: {count}, total_bytes: {total_bytes}, {args.upload_tag}")
+            logging.info("Run complete.")
+    finally:
+        args.uploaded_log.close()
+        args.skipped_log.close()
 
 
 if __name__ == "__main__":
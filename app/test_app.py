@@ -1,19 +1,23 @@
 import os
 import pytest
 import yaml
-import pandas as pd
 from pathlib import Path
 import sys
 from datetime import datetime, timezone
 import shutil
-import pandas as pd
+import csv
 import time
+import tarfile
+import json
+import signal
+import threading
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 
 from app import (
-    load_yaml_file, validate_metadata, read_csv, append_to_csv,
-    iso_utc, file_already_uploaded, compute_file_hash,
-    zip_directory, discover_files
+    load_yaml_file, validate_metadata, read_upload_history, BatchedCsvWriter,
+    iso_utc, utc_now, file_already_uploaded, compute_file_hash, HashCache,
+    zip_directory, tar_zst_directory, discover_files, main, handle_sigterm, UPLOADED_COLUMNS
 )
 
 from unittest.mock import patch, MagicMock
@@ -52,26 +56,121 @@ def test_validate_metadata_missing(caplog):
 
 
 
-def test_read_csv_creates_new(tmp_path):
+def test_read_upload_history(tmp_path):
     path = tmp_path / "uploaded_files.csv"
-    df = read_csv(path)
-    assert path.exists()
-    assert list(df.columns) == [
-        "original_path",
-        "filename",
-        "last_modified_timestamp_source",
-        "file_hash"
-    ]
+    assert read_upload_history(path) == (set(), set())
+
+    log = BatchedCsvWriter(path, UPLOADED_COLUMNS)
+    log.append({
+        "original_path": "/data/a.txt",
+        "filename": "a.txt",
+        "last_modified_timestamp_source": 1700000000.25,
+        "file_hash": "abc123",
+        "size_bytes": 5
+    })
+    log.close()
 
+    with open(path) as f:
+        assert f.readline().strip().split(",") == UPLOADED_COLUMNS
+    assert read_upload_history(path) == ({"abc123"}, {("a.txt", 5, 1700000000.25)})
 
 
-def test_append_to_csv_creates_and_appends(tmp_path):
+def test_upload_history_written_by_older_version(tmp_path):
+    # Logs from before size_bytes was recorded gain the column; their rows still dedupe by hash
+    path = tmp_path / "uploaded_files.csv"
+    path.write_text("original_path,filename,last_modified_timestamp_source,file_hash\n/data/a.txt,a.txt,1.0,abc\n")
+
+    log = BatchedCsvWriter(path, UPLOADED_COLUMNS)
+    log.append({
+        "original_path": "/data/b.txt",
+        "filename": "b.txt",
+        "last_modified_timestamp_source": 2.0,
+        "file_hash": "def",
+        "size_bytes": 5
+    })
+    log.close()
+
+    with open(path, newline="") as f:
+        header = next(csv.reader(f))
+    assert header == UPLOADED_COLUMNS
+    # Only the row logged after the migration has a size, so only it yields a fingerprint
+    assert read_upload_history(path) == ({"abc", "def"}, {("b.txt", 5, 2.0)})
+    assert read_csv_rows(path)[0]["size_bytes"] == ""
+
+
+def test_discover_files_skips_known_fingerprint(tmp_path):
+    f = tmp_path / "a.txt"
+    f.write_text("hello")
+    st = f.stat()
+
+    with patch("app.compute_file_hash") as mock_hash:
+        files, _ = discover_files(
+            str(tmp_path), None, recursive=False,
+            uploaded_hashes=set(),
+            skip_last_n=0,
+            sort_key="name",
+            transfer_symlinks=True,
+            uploaded_fingerprints={("a.txt", st.st_size, st.st_mtime)}
+        )
+        mock_hash.assert_not_called()
+    assert files == []
+
+
+def test_discover_files_drops_oversized_before_limit(tmp_path):
+    # The oldest file is too big; it must neither be hashed nor take the only place
+    for i, (name, data) in enumerate([("big.bin", b"x" * 100), ("small.txt", b"a"), ("newest.txt", b"b")]):
+        (tmp_path / name).write_bytes(data)
+        os.utime(tmp_path / name, (1000 + i, 1000 + i))
+
+    oversized = []
+    with patch("app.compute_file_hash", side_effect=lambda path, algo: path) as mock_hash:
+        files, _ = discover_files(
+            str(tmp_path), None, recursive=False,
+            uploaded_hashes=set(),
+            skip_last_n=1,
+            sort_key="mtime",
+            transfer_symlinks=True,
+            limit=1,
+            max_file_size=10,
+            on_oversized=oversized.append
+        )
+    assert [f.name for f in files] == ["small.txt"]
+    assert [f.name for f in oversized] == ["big.bin"]
+    assert str(tmp_path / "big.bin") not in [call.args[0] for call in mock_hash.call_args_list]
+
+
+def read_csv_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_batched_csv_writer_buffers_and_appends(tmp_path):
     path = tmp_path / "file.csv"
     row = {"a": 1, "b": 2}
-    append_to_csv(path, row)
-    df = pd.read_csv(path)
-    assert len(df) == 1
-    assert df.iloc[0]["a"] == 1
+    log = BatchedCsvWriter(path, ["a", "b"], batch_size=2, flush_interval=60)
+    log.append(row)
+    assert path.read_text().splitlines() == ["a,b"]  # header only, row still buffered
+    log.append(row)
+    assert len(read_csv_rows(path)) == 2  # batch_size reached
+    log.append(row)
+    log.close()
+
+    # With batching disabled rows are only written on close
+    log = BatchedCsvWriter(path, ["a", "b"], batch_size=None, flush_interval=None)
+    for _ in range(100):
+        log.append(row)
+    assert len(read_csv_rows(path)) == 3
+    log.close()
+    assert len(read_csv_rows(path)) == 103
+
+    # Reopening an existing file must not write the header again
+    log = BatchedCsvWriter(path, ["a", "b"])
+    log.append(row)
+    log.close()
+
+    rows = read_csv_rows(path)
+    assert len(rows) == 104
+    assert rows[0]["a"] == "1"
 
 
 def test_iso_utc_conversion():
@@ -80,44 +179,98 @@ def test_iso_utc_conversion():
     assert dt.endswith("Z") or dt.endswith("+00:00")
 
 
+def test_utc_now_format():
+    now = utc_now()
+    assert now.endswith("Z") or now.endswith("+00:00")
+    parsed = datetime.fromisoformat(now)
+    assert abs(parsed.timestamp() - time.time()) < 5
+
+
 def test_file_already_uploaded_match(tmp_path):
     test_file = tmp_path / "a.txt"
     test_file.write_text("hello")
 
     file_hash = compute_file_hash(test_file)
 
-    df = pd.DataFrame([{
-        "original_path": str(test_file),
-        "filename": "a.txt",
-        "last_modified_timestamp_source": test_file.stat().st_mtime,
-        "file_hash": file_hash
-    }])
+    assert file_already_uploaded(str(test_file), {file_hash}) is True
+    assert file_already_uploaded(str(test_file), set()) is False
+
+def test_compute_file_hash_algorithms(tmp_path):
+    f = tmp_path / "a.txt"
+    f.write_text("hello")
+
+    # SHA-256 stays unprefixed so existing upload histories still match
+    assert compute_file_hash(f) == compute_file_hash(f, "sha256")
+    assert ":" not in compute_file_hash(f)
+    assert compute_file_hash(f, "blake2b").startswith("blake2b:")
+
+
+def test_hash_cache_reuses_unchanged_files(tmp_path):
+    f = tmp_path / "a.txt"
+    f.write_text("hello")
+    st = f.stat()
+    cache_path = tmp_path / "hash_cache.json"
+
+    cache = HashCache(cache_path)
+    file_hash = cache.file_hash(str(f), st.st_size, st.st_mtime)
+    cache.save()
+    assert file_hash == compute_file_hash(f)
+
+    # Unchanged size and mtime: served from the saved cache without reading the file
+    with patch("app.compute_file_hash") as mock_hash:
+        assert HashCache(cache_path).file_hash(str(f), st.st_size, st.st_mtime) == file_hash
+        mock_hash.assert_not_called()
+
+    # A changed mtime invalidates the entry
+    with patch("app.compute_file_hash", return_value="new") as mock_hash:
+        assert HashCache(cache_path).file_hash(str(f), st.st_size, st.st_mtime + 1) == "new"
+        mock_hash.assert_called_once()
 
-    assert file_already_uploaded(str(test_file), df) is True
 
 def test_zip_directory_creates_zip(tmp_path):
     d = tmp_path / "dir"
     d.mkdir()
     f = d / "f.txt"
     f.write_text("hello")
+    (d / "g.gz").write_bytes(b"already compressed")
+    big = os.urandom(1 << 16) * 90  # mmap path, spanning more than one copy slice
+    (d / "big.bin").write_bytes(big)
     zipf = zip_directory(d, level=1)
     assert zipf.endswith(".zip")
     assert os.path.exists(zipf)
+    with ZipFile(zipf) as z:
+        assert z.testzip() is None
+        assert z.read("f.txt") == b"hello"
+        assert z.getinfo("f.txt").compress_type == ZIP_DEFLATED
+        assert z.getinfo("g.gz").compress_type == ZIP_STORED
+        assert z.read("big.bin") == big
 
 
+def test_tar_zst_directory_roundtrip(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    d = tmp_path / "dir"
+    (d / "sub").mkdir(parents=True)
+    (d / "f.txt").write_text("hello")
+    (d / "sub" / "g.txt").write_text("world")
+    archive = tar_zst_directory(d, level=3, workers=2)
+    assert archive.endswith(".tar.zst")
+
+    with open(archive, "rb") as fh:
+        with zstandard.ZstdDecompressor().stream_reader(fh) as reader:
+            with tarfile.open(mode="r|", fileobj=reader) as tar:
+                names = sorted(m.name for m in tar)
+    assert names == ["f.txt", os.path.join("sub", "g.txt")]
+    os.remove(archive)
+
 def test_discover_files_filters_symlinks(tmp_path):
     real_file = tmp_path / "a.txt"
     real_file.write_text("x")
     symlink = tmp_path / "link.txt"
     symlink.symlink_to(real_file)
 
-    df = pd.DataFrame(columns=[
-        "original_path", "filename", "last_modified_timestamp_source", "file_hash"
-    ])
-
-    files = discover_files(
+    files, _ = discover_files(
         str(tmp_path), None, recursive=False,
-        uploaded_df=df,
+        uploaded_hashes=set(),
         skip_last_n=0,
         sort_key="name",
         transfer_symlinks=False
@@ -125,7 +278,24 @@ def test_discover_files_filters_symlinks(tmp_path):
 
     # Only the real file should be included, not the symlink
     assert len(files) == 1
-    assert files[0]["path"] == str(real_file)
+    assert files[0].path == str(real_file)
+
+def test_discover_files_skips_non_regular(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.txt").write_text("x")
+    os.mkfifo(tmp_path / "pipe")
+    (tmp_path / "dirlink").symlink_to(tmp_path / "sub")
+
+    files, _ = discover_files(
+        str(tmp_path), None, recursive=False,
+        uploaded_hashes=set(),
+        skip_last_n=0,
+        sort_key="name",
+        transfer_symlinks=True
+    )
+
+    # FIFOs and symlinked directories are never hashed or uploaded
+    assert [f.name for f in files] == ["a.txt"]
 
 def test_discover_files_skips_recent(tmp_path):
     f1 = tmp_path / "a.txt"
@@ -135,13 +305,9 @@ def test_discover_files_skips_recent(tmp_path):
     time.sleep(1)  # ensure different mtimes
     f2.write_text("data2")
 
-    df = pd.DataFrame(columns=[
-        "original_path", "filename", "last_modified_timestamp_source", "file_hash"
-    ])
-
-    files = discover_files(
+    files, _ = discover_files(
         str(tmp_path), None, recursive=False,
-        uploaded_df=df,
+        uploaded_hashes=set(),
         skip_last_n=1,
         sort_key="mtime",
         transfer_symlinks=True
@@ -149,22 +315,197 @@ def test_discover_files_skips_recent(tmp_path):
 
     # Only 1 file should be returned (the older one)
     assert len(files) == 1
-    assert files[0]["path"] == str(f1)
+    assert files[0].path == str(f1)
+    # The hash computed for dedupe is kept so uploading doesn't hash again
+    assert files[0].file_hash == compute_file_hash(f1)
 
 
-    def test_discover_files_multiple_extensions(tmp_path):
-        (tmp_path / "file.csv").write_text("csv")
-        (tmp_path / "file.zip").write_text("zip")
-        (tmp_path / "file.txt").write_text("txt")
+def test_discover_files_limit_after_skip(tmp_path):
+    for name in ["c.txt", "a.txt", "d.txt", "b.txt"]:
+        (tmp_path / name).write_text(name)
 
-        df = pd.DataFrame(columns=["original_path", "filename", "last_modified_timestamp_source", "file_hash"])
-        files = discover_files(
-            str(tmp_path),
-            "*.{" + ",".join(["csv", "zip"]) + "}",
-            recursive=False,
-            uploaded_df=df,
-            skip_last_n=0,
+    def names(**kwargs):
+        files, _ = discover_files(
+            str(tmp_path), None, recursive=False,
+            uploaded_hashes=set(),
             sort_key="name",
-            transfer_symlinks=True
+            transfer_symlinks=True,
+            **kwargs
         )
-        assert len(files) == 2
+        return [f.name for f in files]
+
+    assert names(skip_last_n=1) == ["a.txt", "b.txt", "c.txt"]
+    assert names(skip_last_n=1, hash_workers=3) == ["a.txt", "b.txt", "c.txt"]
+    assert names(skip_last_n=1, limit=2) == ["a.txt", "b.txt"]
+    # The skipped file is taken from the end of the full list, not from the limited one
+    assert names(skip_last_n=1, limit=10) == ["a.txt", "b.txt", "c.txt"]
+
+    # The pending count covers the whole backlog, not just the limited selection
+    _, pending = discover_files(str(tmp_path), None, recursive=False, uploaded_hashes=set(), skip_last_n=1,
+                                sort_key="name", transfer_symlinks=True, limit=1)
+    assert pending == 3
+    files, _ = discover_files(str(tmp_path), None, recursive=False, uploaded_hashes=set(), skip_last_n=1,
+                              sort_key="name", transfer_symlinks=True, limit=1,
+                              exclude={str(tmp_path / "a.txt")})
+    assert [f.name for f in files] == ["b.txt"]
+
+
+def test_discover_files_multiple_extensions(tmp_path):
+    (tmp_path / "file.csv").write_text("csv")
+    (tmp_path / "file.ZIP").write_text("zip")
+    (tmp_path / "file.txt").write_text("txt")
+
+    files, _ = discover_files(
+        str(tmp_path),
+        "*.{" + ",".join(["csv", "zip"]) + "}",
+        recursive=False,
+        uploaded_hashes=set(),
+        skip_last_n=0,
+        sort_key="name",
+        transfer_symlinks=True
+    )
+    assert sorted(f.name for f in files) == ["file.ZIP", "file.csv"]
+
+
+
+def make_source(tmp_path, files):
+    """Source folder with a .forager config and the given (name, data) files, oldest first."""
+    forager = tmp_path / ".forager"
+    forager.mkdir()
+    fields = ["upload_name", "site", "sensor", "creator", "original_path"]
+    (forager / "metadata.yaml").write_text(yaml.safe_dump({field: "x" for field in fields}))
+    for i, (name, data) in enumerate(files):
+        (tmp_path / name).write_bytes(data)
+        os.utime(tmp_path / name, (1000 + i, 1000 + i))
+    return tmp_path
+
+
+def run_main(source, *argv, upload_file=None):
+    """Run main() against a mocked Plugin and return the plugin instance it used."""
+    with patch("app.Plugin") as plugin_cls, patch("app.signal.signal") as set_handler, \
+            patch.object(sys, "argv", ["app.py", "--source", str(source), *argv]):
+        plugin = plugin_cls.return_value.__enter__.return_value
+        plugin.upload_file.side_effect = upload_file
+        main()
+    set_handler.assert_called_once_with(signal.SIGTERM, handle_sigterm)
+    return plugin
+
+
+def test_main_failed_and_oversized_files_dont_use_up_num_files(tmp_path):
+    source = make_source(tmp_path, [
+        ("big.bin", b"x" * 100), ("bad.txt", b"a"), ("c.txt", b"c"), ("d.txt", b"d"), ("newest.txt", b"e")
+    ])
+
+    def upload_file(path, meta, timestamp, keep):
+        if path.endswith("bad.txt"):
+            raise OSError("disk error")
+
+    plugin = run_main(source, "--num-files", "2", "--max-file-size", "10", "--sleep", "0", upload_file=upload_file)
+
+    assert [os.path.basename(c.args[0]) for c in plugin.upload_file.call_args_list] == ["bad.txt", "c.txt", "d.txt"]
+    assert [row["filename"] for row in read_csv_rows(source / ".forager" / "uploaded_files.csv")] == ["c.txt", "d.txt"]
+    skipped = read_csv_rows(source / ".forager" / "skipped_files.csv")
+    assert [(os.path.basename(row["file_path"]), row["reason_skipped"]) for row in skipped] == [
+        ("big.bin", "max_size_exceeded"), ("bad.txt", "disk error")
+    ]
+    # The status reports the whole backlog (newest.txt is held back), not just this run's share
+    plugin.publish.assert_any_call("status", "Found 3 recent files. upload_name: x")
+
+
+def test_main_stops_rescanning_when_every_upload_fails(tmp_path):
+    source = make_source(tmp_path, [(f"f{i:02}.txt", b"x") for i in range(30)])
+
+    def upload_file(path, meta, timestamp, keep):
+        raise OSError("upload dir not writable")
+
+    with patch("app.discover_files", wraps=discover_files) as discover:
+        plugin = run_main(source, "--num-files", "3", "--sleep", "0", upload_file=upload_file)
+    assert discover.call_count == 1
+    assert plugin.upload_file.call_count == 3
+
+
+def test_main_paces_uploads(tmp_path):
+    source = make_source(tmp_path, [(f"{name}.txt", b"x") for name in "abc"])
+
+    with patch("time.sleep") as sleep:
+        plugin = run_main(source, "--num-files", "3", "--skip-last-file", "0", "--sleep", "5")
+    assert plugin.upload_file.call_count == 3
+    assert len(read_csv_rows(source / ".forager" / "uploaded_files.csv")) == 3
+    # Before the second and third uploads, never after the last one. The mocked sleep returns at
+    # once, so the third start is still 10s after the first.
+    assert [round(c.args[0]) for c in sleep.call_args_list] == [5, 10]
+    plugin.publish.assert_any_call("upload.stats", "transferred_count: 3, total_bytes: 3, upload_name: x")
+
+    with patch("time.sleep") as sleep:
+        plugin = run_main(source, "--num-files", "3", "--skip-last-file", "0", "--sleep", "5", "--dry-run")
+    sleep.assert_not_called()
+    plugin.upload_file.assert_not_called()
+
+
+def test_main_slow_upload_does_not_hold_up_other_workers(tmp_path):
+    source = make_source(tmp_path, [(f"{name}.txt", b"x") for name in "abcd"])
+    last_started = threading.Event()
+    waited = []
+
+    def upload_file(path, meta, timestamp, keep):
+        if path.endswith("a.txt"):
+            # Only finishes early if the second worker gets through b, c and d meanwhile
+            waited.append(last_started.wait(5))
+        elif path.endswith("d.txt"):
+            last_started.set()
+
+    plugin = run_main(source, "--num-files", "4", "--skip-last-file", "0", "--sleep", "0",
+                      "--concurrency", "2", upload_file=upload_file)
+    assert waited == [True]
+    assert plugin.upload_file.call_count == 4
+    assert len(read_csv_rows(source / ".forager" / "uploaded_files.csv")) == 4
+
+
+def test_main_rejects_zero_concurrency(tmp_path):
+    source = make_source(tmp_path, [])
+    with pytest.raises(SystemExit):
+        run_main(source, "--concurrency", "0")
+
+
+def test_main_flushes_logs_when_terminated(tmp_path):
+    source = make_source(tmp_path, [("big.bin", b"x" * 100), ("a.txt", b"a"), ("b.txt", b"b"), ("c.txt", b"c")])
+
+    def upload_file(path, meta, timestamp, keep):
+        if path.endswith("b.txt"):
+            handle_sigterm(signal.SIGTERM, None)
+
+    with pytest.raises(SystemExit) as exc:
+        run_main(source, "--num-files", "3", "--max-file-size", "10", "--sleep", "0", upload_file=upload_file)
+    assert exc.value.code == 128 + signal.SIGTERM
+    # The row uploaded before the signal and the buffered skip row both reach disk
+    assert [row["filename"] for row in read_csv_rows(source / ".forager" / "uploaded_files.csv")] == ["a.txt"]
+    assert [row["reason_skipped"] for row in read_csv_rows(source / ".forager" / "skipped_files.csv")] == [
+        "max_size_exceeded"
+    ]
+
+
+def test_main_stops_queued_uploads_when_terminated(tmp_path):
+    source = make_source(tmp_path, [(f"{name}.txt", b"x") for name in "abcdefgh"])
+    uploaded = []
+
+    def upload_file(path, meta, timestamp, keep):
+        uploaded.append(os.path.basename(path))
+        if path.endswith("b.txt"):
+            handle_sigterm(signal.SIGTERM, None)
+
+    with pytest.raises(SystemExit):
+        run_main(source, "--num-files", "8", "--sleep", "0", "--concurrency", "2", upload_file=upload_file)
+    # a and b, plus at most the one file the freed worker picked up before the queue was cancelled
+    assert len(uploaded) <= 3
+    assert "a.txt" in [row["filename"] for row in read_csv_rows(source / ".forager" / "uploaded_files.csv")]
+    # Hashes from the scan survive the interrupted run
+    with open(source / ".forager" / "hash_cache.json") as f:
+        assert len(json.load(f)) == 8
+
+
+def test_main_invalid_multi_extension_glob(tmp_path, caplog):
+    source = make_source(tmp_path, [("a.txt", b"a")])
+    plugin = run_main(source, "--glob", "{a,b}.txt", "--sleep", "0")
+    assert "Invalid multi-extension glob pattern" in caplog.text
+    plugin.upload_file.assert_not_called()
+    plugin.publish.assert_any_call("status", "Found 0 recent files. upload_name: x")